@@ -1,46 +1,146 @@
 import time
 import os
+import sys
 import pandas as pd
 from tqdm import tqdm
-from config import PROMPT_FILE, INPUT_FILE, OUTPUT_FILE, INPUT_COLUMN
+from config import (
+    PROMPT_FILE, INPUT_FILE, OUTPUT_FILE, INPUT_COLUMN, DRY_RUN, STREAM,
+    FIELDS, MODEL_NAME, CALL_PARAMS, CASCADE, CHEAP_MODEL_NAME, CASCADE_ACCEPT, CASCADE_ALLOW_LIST,
+    CASCADE_AGREE_FIELDS, CASCADE_SAMPLE_PARAMS, CASCADE_CONFIDENCE_FIELD, CASCADE_CONFIDENCE_THRESHOLD,
+)
 from utils import (
     load_prompt,
     generate_prompt,
+    compute_provenance,
     get_gpt_response,
+    stream_gpt_response,
+    accept_cheap_response,
     correct_json_response,
     extract_json_from_cell,
     is_valid_json
 )
 
+def call_model(prompt, model_name=MODEL_NAME, params=None):
+    """Call the model (streamed if STREAM); returns (response, streaming stats or None)."""
+    if not STREAM:
+        return get_gpt_response(prompt, model_name, params), None
+    return stream_gpt_response(prompt, model_name, params)
+
+def record_stream_stats(idx, stats_list, prefix=""):
+    """Record streaming stats of one tier on the row; several calls (cheap samples) are combined."""
+    if not STREAM:
+        return
+    data.at[idx, prefix + "TTFT"] = stats_list[0]["TTFT"] if stats_list else None
+    tokens = [st["StreamTokens"] for st in stats_list]
+    # None means the API did not report a token count for one of the calls
+    data.at[idx, prefix + "StreamTokens"] = sum(tokens) if tokens and None not in tokens else None
+    data.at[idx, prefix + "EarlyStop"] = any(st["EarlyStop"] for st in stats_list) if stats_list else None
+    data.at[idx, prefix + "TrailingText"] = stats_list[0]["TrailingText"] if stats_list else None
+
 # Load the prompt template
 prompt_template = load_prompt(PROMPT_FILE)
 
-# If an existing output file is found, resume from it; otherwise start from the input file
-if os.path.exists(OUTPUT_FILE):
-    print(f"Found existing output file. Loading from {OUTPUT_FILE}")
-    data = pd.read_excel(OUTPUT_FILE, sheet_name=0)
-else:
-    print(f"No previous output found. Starting fresh from {INPUT_FILE}")
-    data = pd.read_excel(INPUT_FILE, sheet_name=0)
+# Always read the input file; matching results from an existing output file are reused below
+data = pd.read_excel(INPUT_FILE, sheet_name=0)
 
 # Verify that the input column exists
 if INPUT_COLUMN not in data.columns:
     raise ValueError(f"The input file must contain a '{INPUT_COLUMN}' column.")
+if CASCADE and CASCADE_ACCEPT not in ("allow_list", "agreement", "confidence"):
+    raise ValueError(f"Unknown CASCADE_ACCEPT mode: {CASCADE_ACCEPT!r}")
+# Misconfigured acceptance checks would silently accept (or escalate) every row
+if CASCADE and CASCADE_ACCEPT == "allow_list":
+    if not CASCADE_ALLOW_LIST:
+        raise ValueError("CASCADE_ACCEPT='allow_list' requires a non-empty CASCADE_ALLOW_LIST.")
+    unknown = [f for f in CASCADE_ALLOW_LIST if f not in FIELDS]
+    if unknown:
+        raise ValueError(f"CASCADE_ALLOW_LIST keys {unknown} are not in FIELDS {FIELDS}.")
+if CASCADE and CASCADE_ACCEPT == "agreement":
+    unknown = [f for f in CASCADE_AGREE_FIELDS if f not in FIELDS]
+    if not CASCADE_AGREE_FIELDS or unknown:
+        raise ValueError(f"CASCADE_AGREE_FIELDS must be a non-empty subset of FIELDS {FIELDS}.")
+if CASCADE and CASCADE_ACCEPT == "confidence" and CASCADE_CONFIDENCE_FIELD not in FIELDS:
+    raise ValueError(f"CASCADE_CONFIDENCE_FIELD '{CASCADE_CONFIDENCE_FIELD}' must be listed in FIELDS {FIELDS}.")
+if CASCADE and CASCADE_ACCEPT == "confidence" and not 0.0 <= CASCADE_CONFIDENCE_THRESHOLD <= 1.0:
+    raise ValueError(f"CASCADE_CONFIDENCE_THRESHOLD must be between 0 and 1, got {CASCADE_CONFIDENCE_THRESHOLD}.")
+
+# Provenance of each input row (template, fields, model, input text and call parameters)
+current_provenance = {
+    idx: compute_provenance(prompt_template, row[INPUT_COLUMN]) for idx, row in data.iterrows()
+}
+
+# Resume: reuse previous results by their stored provenance, so inserting, deleting or
+# re-sorting reports in INPUT_FILE does not invalidate the other rows
+stale_count = 0
+if os.path.exists(OUTPUT_FILE):
+    print(f"Found existing output file. Reusing matching results from {OUTPUT_FILE}")
+    previous = pd.read_excel(OUTPUT_FILE, sheet_name=0)
+    result_columns = [c for c in previous.columns if c not in data.columns]
+    previous_processed = [
+        prev for _, prev in previous.iterrows()
+        if pd.notnull(prev.get("Response")) and str(prev.get("Response")).strip() != ""
+    ]
+    previous_by_provenance = {str(prev.get("Provenance")): prev for prev in previous_processed}
+    current_set = set(current_provenance.values())
+    stale_count = sum(1 for prev in previous_processed if str(prev.get("Provenance")) not in current_set)
+    for col in result_columns:
+        data[col] = None
+    for idx, prov in current_provenance.items():
+        prev = previous_by_provenance.get(prov)
+        if prev is not None:
+            for col in result_columns:
+                data.at[idx, col] = prev[col]
+else:
+    print(f"No previous output found. Starting fresh from {INPUT_FILE}")
 
-# Create response/time columns if they do not exist
+# Create response/time/provenance columns if they do not exist
 if 'Response' not in data.columns:
     data['Response'] = None
 if 'Response2' not in data.columns:
     data['Response2'] = None
 if 'Time' not in data.columns:
     data['Time'] = None
+if 'Provenance' not in data.columns:
+    data['Provenance'] = None
+data['Provenance'] = data['Provenance'].astype(object)
+if STREAM:
+    stream_columns = ['TTFT', 'StreamTokens', 'EarlyStop', 'TrailingText']
+    if CASCADE:
+        # Cheap-tier streaming stats get their own columns so the large call does not overwrite them
+        stream_columns += ['Cheap' + col for col in stream_columns]
+    for col in stream_columns:
+        if col not in data.columns:
+            data[col] = None
+if CASCADE:
+    for col in ['Tier', 'CheapTime']:
+        if col not in data.columns:
+            data[col] = None
 
-# ▶ Pre-scan rows that have already been processed
+# ▶ Pre-scan rows: skip those whose results were reused (unchanged provenance)
 skipped_indices = [idx for idx, row in data.iterrows()
                    if pd.notnull(row['Response']) and str(row['Response']).strip() != ""]
+pending_count = data.shape[0] - len(skipped_indices)
 
 if skipped_indices:
-    print(f"Skipping {len(skipped_indices)} already-processed rows...")
+    print(f"Skipping {len(skipped_indices)} rows with unchanged provenance...")
+if stale_count:
+    print(f"{stale_count} previous results no longer match (prompt, fields, model, input or params changed)...")
+
+cheap_samples = 2 if CASCADE_ACCEPT == "agreement" else 1  # first sample uses CALL_PARAMS
+
+if DRY_RUN:
+    if CASCADE:
+        print(f"Dry run: {pending_count} rows to process ({stale_count} previous results stale) "
+              f"-> {cheap_samples * pending_count} {CHEAP_MODEL_NAME} calls "
+              f"+ up to {pending_count} {MODEL_NAME} calls for escalated rows. Nothing was sent.")
+    else:
+        print(f"Dry run: {pending_count} rows to process ({stale_count} previous results stale) "
+              f"-> at least {pending_count} API calls "
+              f"(+1 per row needing JSON correction). Nothing was sent.")
+    sys.exit(0)
+
+# Cascade bookkeeping for this run: cheap-tier seconds per row, large-tier seconds per escalated row
+cheap_times, large_times = [], []
 
 # ▶ Process each row
 for idx, row in tqdm(data.iterrows(), total=data.shape[0], desc="Processing Rows"):
@@ -52,8 +152,33 @@ for idx, row in tqdm(data.iterrows(), total=data.shape[0], desc="Processing Rows
 
     start_time = time.perf_counter()
 
-    response = get_gpt_response(prompt)
+    tier = 'large'
+    large_stats = []
+    if CASCADE:
+        # Cheap tier first; keep its answer only if it passes the acceptance check.
+        # The kept answer is always the CALL_PARAMS sample; extra agreement samples use CASCADE_SAMPLE_PARAMS.
+        cheap_calls = [call_model(prompt, CHEAP_MODEL_NAME)]
+        for _ in range(cheap_samples - 1):
+            cheap_calls.append(call_model(prompt, CHEAP_MODEL_NAME, {**CALL_PARAMS, **CASCADE_SAMPLE_PARAMS}))
+        cheap_responses = [r for r, _ in cheap_calls]
+        record_stream_stats(idx, [st for _, st in cheap_calls], prefix='Cheap')
+        cheap_time = time.perf_counter() - start_time
+        cheap_times.append(cheap_time)
+        data.at[idx, 'CheapTime'] = round(cheap_time, 4)
+        if accept_cheap_response(cheap_responses):
+            tier = 'cheap'
+            response = cheap_responses[0]
+
+    if tier == 'large':
+        large_start = time.perf_counter()
+        response, stream_stats = call_model(prompt)
+        large_stats = [stream_stats]
+        if CASCADE:
+            large_times.append(time.perf_counter() - large_start)
+    record_stream_stats(idx, large_stats)
     data.at[idx, 'Response'] = response
+    if CASCADE:
+        data.at[idx, 'Tier'] = tier
 
     extracted_json = extract_json_from_cell(response)
     if not is_valid_json(extracted_json):
@@ -64,6 +189,7 @@ for idx, row in tqdm(data.iterrows(), total=data.shape[0], desc="Processing Rows
 
     end_time = time.perf_counter()
     data.at[idx, 'Time'] = round(end_time - start_time, 4)
+    data.at[idx, 'Provenance'] = current_provenance[idx]
 
     # Periodic checkpoint saving
     if (idx + 1) % 10 == 0:
@@ -73,3 +199,20 @@ for idx, row in tqdm(data.iterrows(), total=data.shape[0], desc="Processing Rows
 # Final save
 data.to_excel(OUTPUT_FILE, index=False)
 print(f"Final result saved to {OUTPUT_FILE}")
+
+if STREAM:
+    for prefix, label in ([('Cheap', CHEAP_MODEL_NAME)] if CASCADE else []) + [('', MODEL_NAME)]:
+        streamed = data[data[prefix + 'TTFT'].notnull()]
+        if not streamed.empty:
+            print(f"Streaming ({label}): {int(streamed[prefix + 'EarlyStop'].astype(bool).sum())}/{len(streamed)} "
+                  f"rows stopped early, mean TTFT {streamed[prefix + 'TTFT'].astype(float).mean():.3f}s, "
+                  f"mean tokens received {streamed[prefix + 'StreamTokens'].astype(float).mean():.1f}")
+
+if CASCADE and cheap_times:
+    accepted = len(cheap_times) - len(large_times)
+    print(f"Cascade: {len(large_times)}/{len(cheap_times)} rows escalated to {MODEL_NAME} "
+          f"({len(large_times) / len(cheap_times):.1%}); {accepted} {MODEL_NAME} calls avoided")
+    if large_times:
+        # Latency saved = large-model time avoided on accepted rows - time spent on the cheap tier
+        saved = accepted * (sum(large_times) / len(large_times)) - sum(cheap_times)
+        print(f"Cascade: estimated latency saved vs. {MODEL_NAME} only: {saved:.1f}s")
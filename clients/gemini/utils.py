@@ -1,10 +1,23 @@
+import hashlib
 import json
+import time
 import google.generativeai as genai
-from config import MODEL_NAME, GEMINI_API_KEY, FIELDS
+from config import (
+    MODEL_NAME, GEMINI_API_KEY, FIELDS, CALL_PARAMS,
+    CASCADE, CHEAP_MODEL_NAME, CASCADE_ACCEPT, CASCADE_ALLOW_LIST, CASCADE_AGREE_FIELDS,
+    CASCADE_SAMPLE_PARAMS, CASCADE_CONFIDENCE_FIELD, CASCADE_CONFIDENCE_THRESHOLD,
+)
 
 # Configure the Gemini API key
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel(MODEL_NAME)
+_models = {MODEL_NAME: model}
+
+def _get_model(model_name):
+    """Return a cached GenerativeModel for the given name (used by the cascade's cheap tier)."""
+    if model_name not in _models:
+        _models[model_name] = genai.GenerativeModel(model_name)
+    return _models[model_name]
 
 def load_prompt(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -37,6 +50,52 @@ def extract_json_from_cell(cell_value):
             return cell_value[start_index:end_index + 1]
     return None
 
+class JSONObjectScanner:
+    """Incrementally scan streamed text and detect the first complete JSON object with all FIELDS."""
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._start = -1
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk):
+        """Append a chunk; return the JSON object text once a valid object has arrived, else None."""
+        self.buffer += chunk
+        while self._pos < len(self.buffer):
+            ch = self.buffer[self._pos]
+            self._pos += 1
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth, self._start = 1, self._pos - 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = self.buffer[self._start:self._pos].replace("\n", "")
+                    if is_valid_json(candidate):
+                        return self.buffer[self._start:self._pos]
+                    # Not the object we want (e.g. an example in prose) -> keep scanning
+                    self._start = -1
+        return None
+
+    def tail(self):
+        """Text received after the closing brace of the returned object."""
+        return self.buffer[self._pos:]
+
 def _fill_placeholders(template: str, mapping: dict) -> str:
     out = str(template)
     for k, v in mapping.items():
@@ -46,9 +105,16 @@ def _fill_placeholders(template: str, mapping: dict) -> str:
 def generate_prompt(template: str, results: str) -> str:
     return _fill_placeholders(template, {"Results": results})
 
+def _field_placeholder(field):
+    """Placeholder for a field in the JSON schema; the cascade confidence field is a number in [0, 1]."""
+    if CASCADE and CASCADE_ACCEPT == "confidence" and field == CASCADE_CONFIDENCE_FIELD:
+        return "<number between 0 and 1>"
+    return '"<string>"'
+
+
 def _force_json_wrapper(user_prompt: str) -> str:
     """Wrap the prompt to force the model to output JSON only."""
-    fields_spec = ", ".join([f'"{f}": "<string>"' for f in FIELDS])
+    fields_spec = ", ".join([f'"{f}": {_field_placeholder(f)}' for f in FIELDS])
     return f"""
 You must respond with **only** a single JSON object and nothing else (no prose).
 JSON schema:
@@ -60,10 +126,34 @@ User content:
 {user_prompt}
 """
 
-def get_gpt_response(prompt):
+def compute_provenance(template: str, results) -> str:
+    """Hash everything that determines a row's answer (template, fields, model, input, call params)."""
+    payload = {
+        "template": template,
+        "prompt": _force_json_wrapper(generate_prompt(template, results)),
+        "fields": FIELDS,
+        "model": MODEL_NAME,
+        "input": str(results),
+        "params": CALL_PARAMS,
+    }
+    if CASCADE:
+        payload["cascade"] = {
+            "cheap_model": CHEAP_MODEL_NAME,
+            "accept": CASCADE_ACCEPT,
+            "allow_list": CASCADE_ALLOW_LIST,
+            "agree_fields": CASCADE_AGREE_FIELDS,
+            "sample_params": CASCADE_SAMPLE_PARAMS,
+            "confidence": [CASCADE_CONFIDENCE_FIELD, CASCADE_CONFIDENCE_THRESHOLD],
+        }
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def get_gpt_response(prompt, model_name=MODEL_NAME, params=None):
+    """Call the model (MODEL_NAME unless overridden) with CALL_PARAMS unless `params` is given."""
     try:
         wrapped = _force_json_wrapper(prompt)
-        resp = model.generate_content(wrapped)
+        resp = _get_model(model_name).generate_content(
+            wrapped, generation_config=CALL_PARAMS if params is None else params)
         # Depending on the SDK/version, text may appear in resp.text or in candidates[0].content.parts
         text = getattr(resp, "text", None)
         if not text and hasattr(resp, "candidates") and resp.candidates:
@@ -77,6 +167,99 @@ def get_gpt_response(prompt):
         # On error, return an explicit non-JSON string -> will be marked invalid by is_valid_json()
         return f"[ERROR] {type(e).__name__}: {e}"
 
+def stream_gpt_response(prompt, model_name=MODEL_NAME, params=None):
+    """
+    Stream the response and stop reading as soon as a complete JSON object with all FIELDS has arrived.
+    Returns (text, stats) where stats holds TTFT (seconds), StreamTokens (tokens received, including the
+    chunk read after the object, from usage metadata; None if Gemini does not report it), EarlyStop
+    (True only if the model was still sending text when we cancelled) and TrailingText (text received
+    after the object, i.e. what would otherwise be thrown away).
+    """
+    stats = {"TTFT": None, "StreamTokens": None, "EarlyStop": False, "TrailingText": ""}
+    scanner = JSONObjectScanner()
+    complete = None
+    start_time = time.perf_counter()
+    try:
+        wrapped = _force_json_wrapper(prompt)
+        resp = _get_model(model_name).generate_content(
+            wrapped, generation_config=CALL_PARAMS if params is None else params, stream=True)
+        for chunk in resp:
+            candidate = chunk.candidates[0] if getattr(chunk, "candidates", None) else None
+            parts = candidate.content.parts if candidate is not None else []
+            text = "".join(getattr(p, "text", "") for p in parts)
+            finished = bool(candidate is not None and getattr(candidate, "finish_reason", 0))
+            # Gemini chunks carry several tokens, so take the running count from usage metadata
+            usage = getattr(chunk, "usage_metadata", None)
+            token_count = getattr(usage, "candidates_token_count", 0) if usage else 0
+            if token_count:
+                stats["StreamTokens"] = token_count
+            if complete is not None:
+                # One chunk past the object: more text without finish_reason means we cut generation short
+                if text:
+                    stats["TrailingText"] += text
+                    stats["EarlyStop"] = not finished
+                if text or finished:
+                    break
+                continue
+            if not text:
+                continue
+            if stats["TTFT"] is None:
+                stats["TTFT"] = round(time.perf_counter() - start_time, 4)
+            complete = scanner.feed(text)
+            if complete is not None:
+                stats["TrailingText"] = scanner.tail()
+                if finished:
+                    break
+        # The SDK has no public way to cancel the stream; we only stop reading from it here
+        stats["TrailingText"] = stats["TrailingText"].strip()
+        if complete is not None:
+            return complete.strip(), stats
+        if not scanner.buffer:
+            raise RuntimeError("Empty streamed response from Gemini.")
+        return scanner.buffer.strip(), stats
+    except Exception as e:
+        return f"[ERROR] {type(e).__name__}: {e}", stats
+
+def _normalize_label(value) -> str:
+    return str(value).strip().lower()
+
+def accept_cheap_response(responses):
+    """
+    Cascade acceptance check on the cheap-model response(s). True means the answer is kept;
+    False means the row is escalated to MODEL_NAME.
+    - Every response must pass is_valid_json after extraction.
+    - "allow_list": each field in CASCADE_ALLOW_LIST must hold one of the allowed labels.
+    - "agreement": all samples must agree on CASCADE_AGREE_FIELDS.
+    - "confidence": CASCADE_CONFIDENCE_FIELD must be a number in [0, 1] and >= CASCADE_CONFIDENCE_THRESHOLD.
+    """
+    parsed = []
+    for response in responses:
+        extracted = extract_json_from_cell(response)
+        if not is_valid_json(extracted):
+            return False
+        parsed.append(json.loads(extracted))
+    first = parsed[0]
+
+    if CASCADE_ACCEPT == "allow_list":
+        return all(
+            _normalize_label(first.get(field, "")) in {_normalize_label(v) for v in allowed}
+            for field, allowed in CASCADE_ALLOW_LIST.items()
+        )
+    if CASCADE_ACCEPT == "agreement":
+        return len(parsed) > 1 and all(
+            _normalize_label(other.get(field)) == _normalize_label(first.get(field))
+            for other in parsed[1:]
+            for field in CASCADE_AGREE_FIELDS
+        )
+    if CASCADE_ACCEPT == "confidence":
+        try:
+            confidence = float(first.get(CASCADE_CONFIDENCE_FIELD))
+        except (TypeError, ValueError):
+            return False
+        # Values off the requested 0-1 scale (e.g. 85 meaning 85%) cannot be compared to the threshold
+        return 0.0 <= confidence <= 1.0 and confidence >= CASCADE_CONFIDENCE_THRESHOLD
+    raise ValueError(f"Unknown CASCADE_ACCEPT mode: {CASCADE_ACCEPT!r}")
+
 def correct_json_response(response):
     """Fix malformed JSON responses (Gemini-based correction)."""
     fields_spec = ", ".join([f'"{f}": "<string>"' for f in FIELDS])
@@ -103,7 +286,7 @@ def correct_json_response(response):
     ----   
     """
     try:
-        resp = model.generate_content(correction_prompt)
+        resp = model.generate_content(correction_prompt, generation_config=CALL_PARAMS)
         text = getattr(resp, "text", None)
         if not text and hasattr(resp, "candidates") and resp.candidates:
             parts = getattr(resp.candidates[0].content, "parts", [])
@@ -5,7 +5,8 @@ from langchain_ollama import OllamaLLM
 
 # Model configuration
 MODEL_NAME = "llama3.3"  # e.g., "llama3.3", "deepseek-r1:70b", "gemma3:27b", "llama4", "qwen3:32b"
-MODEL = OllamaLLM(model=MODEL_NAME)
+CALL_PARAMS = {}  # extra OllamaLLM options (part of each row's provenance), e.g. {"temperature": 0}
+MODEL = OllamaLLM(model=MODEL_NAME, **CALL_PARAMS)
 
 # Project root (repo root) inferred from this file location
 # Example: repo/clients/local/config.py -> repo/
@@ -21,6 +22,12 @@ FIELDS = ["Tstage", "reason"]
 # Input column name
 INPUT_COLUMN = "Results"  # Column name containing the input text
 
+# Dry run: only report how many rows/calls a re-run would cost, send nothing
+DRY_RUN = False
+
+# Stream responses and stop as soon as a complete JSON object with all FIELDS has arrived
+STREAM = False
+
 ############## Configuration ends here ##############
 
 # Automatically set suffixes
@@ -1,12 +1,13 @@
+import sys
 import time
 import pandas as pd
 from tqdm import tqdm
 from pathlib import Path
 
-from config import BASE_DIR, PROMPT_FILE, INPUT_FILE, OUTPUT_FILE, INPUT_COLUMN
+from config import BASE_DIR, PROMPT_FILE, INPUT_FILE, OUTPUT_FILE, INPUT_COLUMN, DRY_RUN, STREAM
 from utils import (
-    load_prompt, generate_prompt, get_llama_response,
-    verify_llama_response, correct_json_response,
+    load_prompt, generate_prompt, compute_provenance, get_llama_response,
+    stream_llama_response, verify_llama_response, correct_json_response,
     extract_json_from_cell, is_valid_json,
 )
 
@@ -33,31 +34,72 @@ if verify_prompt_template is None:
     )
 
 # ──────────────────────────────────────────
-# ② Resume from an existing output file or start fresh
+# ② Read the input file and reuse matching results from an existing output file
 # ──────────────────────────────────────────
-if OUTPUT_FILE.exists():
-    print(f"Found existing output file. Loading from {OUTPUT_FILE}")
-    data = pd.read_excel(OUTPUT_FILE, sheet_name=0)
-else:
-    print(f"No previous output found. Starting fresh from {INPUT_FILE}")
-    data = pd.read_excel(INPUT_FILE, sheet_name=0)
+data = pd.read_excel(INPUT_FILE, sheet_name=0)
 
 # Validate that the input column exists
 if INPUT_COLUMN not in data.columns:
     raise ValueError(f"The input file must contain a '{INPUT_COLUMN}' column.")
 
-# Create response/time columns if they do not exist
-for col in ["Response", "Response2", "Response3", "Time"]:
+# Provenance of each input row (templates, fields, model, input text and call parameters)
+current_provenance = {
+    idx: compute_provenance(prompt_template, verify_prompt_template, row[INPUT_COLUMN])
+    for idx, row in data.iterrows()
+}
+
+# Resume: reuse previous results by their stored provenance, so inserting, deleting or
+# re-sorting reports in INPUT_FILE does not invalidate the other rows
+stale_count = 0
+if OUTPUT_FILE.exists():
+    print(f"Found existing output file. Reusing matching results from {OUTPUT_FILE}")
+    previous = pd.read_excel(OUTPUT_FILE, sheet_name=0)
+    result_columns = [c for c in previous.columns if c not in data.columns]
+    previous_processed = [
+        prev for _, prev in previous.iterrows()
+        if pd.notnull(prev.get("Response")) and str(prev.get("Response")).strip() != ""
+    ]
+    previous_by_provenance = {str(prev.get("Provenance")): prev for prev in previous_processed}
+    current_set = set(current_provenance.values())
+    stale_count = sum(1 for prev in previous_processed if str(prev.get("Provenance")) not in current_set)
+    for col in result_columns:
+        data[col] = None
+    for idx, prov in current_provenance.items():
+        prev = previous_by_provenance.get(prov)
+        if prev is not None:
+            for col in result_columns:
+                data.at[idx, col] = prev[col]
+else:
+    print(f"No previous output found. Starting fresh from {INPUT_FILE}")
+
+# Create response/time/provenance columns if they do not exist
+stream_columns = ["TTFT", "StreamTokens", "EarlyStop", "TrailingText"] if STREAM else []
+# Verifier-call streaming stats get their own columns so they do not overwrite the draft call's
+stream_columns += ["Verify" + col for col in stream_columns]
+for col in ["Response", "Response2", "Response3", "Time", "Provenance"] + stream_columns:
     if col not in data.columns:
         data[col] = None
+data["Provenance"] = data["Provenance"].astype(object)
 
-# Skip rows that have already been processed
+# Skip rows whose results were reused (unchanged provenance)
 skipped = [
     i for i, r in data.iterrows()
     if pd.notnull(r["Response"]) and str(r["Response"]).strip() != ""
 ]
+pending_count = data.shape[0] - len(skipped)
+
 if skipped:
-    print(f"Skipping {len(skipped)} already-processed rows…")
+    print(f"Skipping {len(skipped)} rows with unchanged provenance…")
+if stale_count:
+    print(f"{stale_count} previous results no longer match (prompts, fields, model, input or params changed)…")
+
+if DRY_RUN:
+    print(
+        f"Dry run: {pending_count} rows to process ({stale_count} previous results stale) "
+        f"-> at least {2 * pending_count} LLM calls "
+        f"(draft + verifier, +1 per row needing JSON correction). Nothing was sent."
+    )
+    sys.exit(0)
 
 # ──────────────────────────────────────────
 # ③ Row-wise processing loop
@@ -71,11 +113,21 @@ for idx, row in tqdm(data.iterrows(), total=data.shape[0], desc="Processing Rows
 
     # 1) First-pass response
     raw_prompt = generate_prompt(prompt_template, report_text)
-    resp1 = get_llama_response(raw_prompt)
+    if STREAM:
+        resp1, stream_stats = stream_llama_response(raw_prompt)
+        for key, value in stream_stats.items():
+            data.at[idx, key] = value
+    else:
+        resp1 = get_llama_response(raw_prompt)
     data.at[idx, "Response"] = resp1
 
     # 2) Content verification (verifier step)
-    resp2 = verify_llama_response(verify_prompt_template, report_text, resp1)
+    if STREAM:
+        resp2, verify_stats = verify_llama_response(verify_prompt_template, report_text, resp1, stream=True)
+        for key in ["TTFT", "StreamTokens", "EarlyStop", "TrailingText"]:
+            data.at[idx, "Verify" + key] = verify_stats[key] if verify_stats else None
+    else:
+        resp2 = verify_llama_response(verify_prompt_template, report_text, resp1)
     data.at[idx, "Response2"] = resp2
 
     # 3) Format check → correct if needed
@@ -87,6 +139,7 @@ for idx, row in tqdm(data.iterrows(), total=data.shape[0], desc="Processing Rows
         data.at[idx, "Response3"] = ""  # Format OK → leave empty
 
     data.at[idx, "Time"] = round(time.perf_counter() - t0, 4)
+    data.at[idx, "Provenance"] = current_provenance[idx]
 
     # Checkpoint every 10 rows
     if (idx + 1) % 10 == 0:
@@ -98,3 +151,13 @@ for idx, row in tqdm(data.iterrows(), total=data.shape[0], desc="Processing Rows
 # ──────────────────────────────────────────
 data.to_excel(OUTPUT_FILE, index=False)
 print(f"Final result saved to {OUTPUT_FILE}")
+
+if STREAM:
+    for prefix, label in [("", "draft"), ("Verify", "verifier")]:
+        streamed = data[data[prefix + "TTFT"].notnull()]
+        if not streamed.empty:
+            print(
+                f"Streaming ({label}): {int(streamed[prefix + 'EarlyStop'].astype(bool).sum())}/{len(streamed)} "
+                f"rows stopped early, mean TTFT {streamed[prefix + 'TTFT'].astype(float).mean():.3f}s, "
+                f"mean tokens received {streamed[prefix + 'StreamTokens'].astype(float).mean():.1f}"
+            )
@@ -1,5 +1,7 @@
+import hashlib
 import json
-from config import MODEL, FIELDS
+import time
+from config import MODEL, MODEL_NAME, FIELDS, CALL_PARAMS
 
 ### Verifier placeholder-replacement checks (non-crashing version)
 
@@ -14,6 +16,52 @@ def _error_json(message: str) -> str:
     """Return a JSON string that fills all fields with the same error message."""
     return json.dumps({field: message for field in FIELDS})
 
+class JSONObjectScanner:
+    """Incrementally scan streamed text and detect the first complete JSON object with all FIELDS."""
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._start = -1
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk):
+        """Append a chunk; return the JSON object text once a valid object has arrived, else None."""
+        self.buffer += chunk
+        while self._pos < len(self.buffer):
+            ch = self.buffer[self._pos]
+            self._pos += 1
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth, self._start = 1, self._pos - 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = self.buffer[self._start:self._pos].replace("\n", "")
+                    if is_valid_json(candidate):
+                        return self.buffer[self._start:self._pos]
+                    # Not the object we want (e.g. an example in prose) -> keep scanning
+                    self._start = -1
+        return None
+
+    def tail(self):
+        """Text received after the closing brace of the returned object."""
+        return self.buffer[self._pos:]
+
 def load_prompt(file_path):
     """Load a prompt template from a file."""
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -42,6 +90,20 @@ def generate_prompt(template, results):
     # ⚠️ Do NOT use format() → use safe replacement instead
     return _fill_placeholders(template, {"Results": results})
 
+def compute_provenance(template: str, verify_template: str, results) -> str:
+    """Hash everything that determines a row's answer (templates, fields, model, input, call params)."""
+    payload = {
+        "template": template,
+        "verify_template": verify_template,
+        "prompt": generate_prompt(template, results),
+        "fields": FIELDS,
+        "model": MODEL_NAME,
+        "input": str(results),
+        "params": CALL_PARAMS,
+    }
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
 def get_llama_response(prompt):
     """Call the local LLM and return raw text. On error, return a JSON string filled with an error message."""
     try:
@@ -50,6 +112,49 @@ def get_llama_response(prompt):
         msg = f"Error: {type(e).__name__}: {e}"
         return _error_json(msg)
 
+def stream_llama_response(prompt):
+    """
+    Stream the local LLM response and cancel as soon as a complete JSON object with all FIELDS has arrived.
+    Returns (text, stats) where stats holds TTFT (seconds), StreamTokens (tokens received, one per streamed
+    token, including the token read after the object), EarlyStop
+    (True only if the model was still sending text when we cancelled) and TrailingText (text received
+    after the object, i.e. what would otherwise be thrown away).
+    On error, the text is a JSON string filled with an error message.
+    """
+    stats = {"TTFT": None, "StreamTokens": 0, "EarlyStop": False, "TrailingText": ""}
+    scanner = JSONObjectScanner()
+    stream = None
+    complete = None
+    start_time = time.perf_counter()
+    try:
+        stream = MODEL.stream(prompt)
+        for token in stream:
+            if not token:
+                continue
+            if complete is not None:
+                # One more token past the object means we cut generation short; end of stream means we did not
+                stats["StreamTokens"] += 1
+                stats["TrailingText"] += token
+                stats["EarlyStop"] = True
+                break
+            if stats["TTFT"] is None:
+                stats["TTFT"] = round(time.perf_counter() - start_time, 4)
+            stats["StreamTokens"] += 1
+            complete = scanner.feed(token)
+            if complete is not None:
+                stats["TrailingText"] = scanner.tail()
+        stats["TrailingText"] = stats["TrailingText"].strip()
+        if complete is not None:
+            return complete.strip(), stats
+        return scanner.buffer.strip(), stats
+    except Exception as e:
+        msg = f"Error: {type(e).__name__}: {e}"
+        return _error_json(msg), stats
+    finally:
+        # Closing the generator stops Ollama from generating the rest
+        if stream is not None:
+            stream.close()
+
 def correct_json_response(response):
     """Fix malformed JSON responses while preserving the original content. Never raises; returns error JSON on failure."""
     correction_prompt = f"""
@@ -74,22 +179,27 @@ Here is your previous response:
         msg = f"Correction Error: {type(e).__name__}: {e}"
         return _error_json(msg)
 
-def verify_llama_response(template: str, results_text: str, draft_json: str) -> str:
+def verify_llama_response(template: str, results_text: str, draft_json: str, stream: bool = False):
     """
     Verifier step that NEVER raises.
+    - If stream is True, the verifier output is streamed and cut off once the JSON object closes, and
+      (text, stats) is returned with the stats of stream_llama_response (None if no call was made).
     - If placeholders are missing or replacement fails, returns an error JSON string (filled for all fields).
     - If the LLM call fails, returns an error JSON string (filled for all fields).
     """
+    def _result(text, stats=None):
+        return (text, stats) if stream else text
+
     required_tokens = ["{Results}", "{draft_json}"]
 
     # 1) Check required placeholders exist in the template
     for token in required_tokens:
         if token not in template:
-            return _error_json(f"Verification Template Error: missing placeholder {token}")
+            return _result(_error_json(f"Verification Template Error: missing placeholder {token}"))
 
     # 2) Validate inputs
     if results_text is None or draft_json is None:
-        return _error_json("Verification Input Error: results_text or draft_json is None")
+        return _result(_error_json("Verification Input Error: results_text or draft_json is None"))
 
     # 3) Perform replacement
     filled_prompt = _fill_placeholders(template, {
@@ -100,9 +210,11 @@ def verify_llama_response(template: str, results_text: str, draft_json: str) ->
     # 4) Ensure placeholders are fully replaced
     for token in required_tokens:
         if token in filled_prompt:
-            return _error_json(f"Verification Template Error: placeholder {token} was not filled correctly")
+            return _result(_error_json(f"Verification Template Error: placeholder {token} was not filled correctly"))
 
     # 5) Call the verifier LLM
+    if stream:
+        return stream_llama_response(filled_prompt)
     try:
         return MODEL.invoke(filled_prompt).strip()
     except Exception as e:
@@ -24,12 +24,31 @@ FIELDS = ["decision", "evidence"]
 # Input column name
 INPUT_COLUMN = "Results"
 
+# Call parameters passed to the API (part of each row's provenance)
+CALL_PARAMS = {"temperature": 0}
+
+# Dry run: only report how many rows/calls a re-run would cost, send nothing
+DRY_RUN = False
+
+# Stream responses and stop as soon as a complete JSON object with all FIELDS has arrived
+STREAM = False
+
+# Cheap-model-first cascade: answer with CHEAP_MODEL_NAME and escalate rejected rows to MODEL_NAME
+CASCADE = False
+CHEAP_MODEL_NAME = "gpt-4.1-mini"
+# Acceptance check for cheap answers: "allow_list", "agreement" or "confidence"
+CASCADE_ACCEPT = "allow_list"
+CASCADE_ALLOW_LIST = {}  # e.g. {FIELDS[0]: ["Yes", "No"]}; fields not listed are not checked
+CASCADE_AGREE_FIELDS = FIELDS[:1]  # "agreement": fields two cheap samples must agree on
+CASCADE_SAMPLE_PARAMS = {"temperature": 0.7}  # "agreement": extra params for the second cheap sample
+CASCADE_CONFIDENCE_FIELD = "confidence"  # "confidence": add this field to FIELDS as well
+CASCADE_CONFIDENCE_THRESHOLD = 0.8  # the model is asked for a number between 0 and 1
 
 ############## Configuration ends here ##############
 
 # Automatically set suffixes
 prompt_filename = PROMPT_FILE.stem
-model_suffix = "_" + MODEL_NAME.replace(":", "_")
+model_suffix = "_" + (f"{CHEAP_MODEL_NAME}-cascade-{MODEL_NAME}" if CASCADE else MODEL_NAME).replace(":", "_")
 
 input_name_lower = INPUT_FILE.name.lower()
 OUTPUT_SUFFIX = (
@@ -1,7 +1,13 @@
+import hashlib
 import json
+import time
 from openai import OpenAI
 
-from config import MODEL_NAME, OPENAI_API_KEY, FIELDS
+from config import (
+    MODEL_NAME, OPENAI_API_KEY, FIELDS, CALL_PARAMS,
+    CASCADE, CHEAP_MODEL_NAME, CASCADE_ACCEPT, CASCADE_ALLOW_LIST, CASCADE_AGREE_FIELDS,
+    CASCADE_SAMPLE_PARAMS, CASCADE_CONFIDENCE_FIELD, CASCADE_CONFIDENCE_THRESHOLD,
+)
 
 # Configure the OpenAI client
 client = OpenAI(api_key=OPENAI_API_KEY)
@@ -34,6 +40,53 @@ def extract_json_from_cell(cell_value):
     return None
 
 
+class JSONObjectScanner:
+    """Incrementally scan streamed text and detect the first complete JSON object with all FIELDS."""
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._start = -1
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk):
+        """Append a chunk; return the JSON object text once a valid object has arrived, else None."""
+        self.buffer += chunk
+        while self._pos < len(self.buffer):
+            ch = self.buffer[self._pos]
+            self._pos += 1
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth, self._start = 1, self._pos - 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = self.buffer[self._start:self._pos].replace("\n", "")
+                    if is_valid_json(candidate):
+                        return self.buffer[self._start:self._pos]
+                    # Not the object we want (e.g. an example in prose) -> keep scanning
+                    self._start = -1
+        return None
+
+    def tail(self):
+        """Text received after the closing brace of the returned object."""
+        return self.buffer[self._pos:]
+
+
 def _fill_placeholders(template: str, mapping: dict) -> str:
     """Replace only the specified tokens (leave JSON braces { } intact)."""
     out = str(template)
@@ -47,9 +100,16 @@ def generate_prompt(template: str, results: str) -> str:
     return _fill_placeholders(template, {"Results": results})
 
 
+def _field_placeholder(field):
+    """Placeholder for a field in the JSON schema; the cascade confidence field is a number in [0, 1]."""
+    if CASCADE and CASCADE_ACCEPT == "confidence" and field == CASCADE_CONFIDENCE_FIELD:
+        return "<number between 0 and 1>"
+    return '"<string>"'
+
+
 def _force_json_wrapper(user_prompt: str) -> str:
     """Wrap the prompt to force the model to output JSON only."""
-    fields_spec = ", ".join([f'"{f}": "<string>"' for f in FIELDS])
+    fields_spec = ", ".join([f'"{f}": {_field_placeholder(f)}' for f in FIELDS])
     return f"""
 You must respond with **only** a single JSON object and nothing else (no prose).
 JSON schema:
@@ -62,16 +122,40 @@ User content:
 """
 
 
-def get_gpt_response(prompt):
+def compute_provenance(template: str, results) -> str:
+    """Hash everything that determines a row's answer (template, fields, model, input, call params)."""
+    payload = {
+        "template": template,
+        "prompt": _force_json_wrapper(generate_prompt(template, results)),
+        "fields": FIELDS,
+        "model": MODEL_NAME,
+        "input": str(results),
+        "params": CALL_PARAMS,
+    }
+    if CASCADE:
+        payload["cascade"] = {
+            "cheap_model": CHEAP_MODEL_NAME,
+            "accept": CASCADE_ACCEPT,
+            "allow_list": CASCADE_ALLOW_LIST,
+            "agree_fields": CASCADE_AGREE_FIELDS,
+            "sample_params": CASCADE_SAMPLE_PARAMS,
+            "confidence": [CASCADE_CONFIDENCE_FIELD, CASCADE_CONFIDENCE_THRESHOLD],
+        }
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def get_gpt_response(prompt, model_name=MODEL_NAME, params=None):
+    """Call the model (MODEL_NAME unless overridden) with CALL_PARAMS unless `params` is given."""
     try:
         wrapped = _force_json_wrapper(prompt)
         response = client.chat.completions.create(
-            model=MODEL_NAME,
+            model=model_name,
             messages=[
                 {"role": "system", "content": "You are a helpful assistant."},
                 {"role": "user", "content": wrapped},
             ],
-            temperature=0,
+            **(CALL_PARAMS if params is None else params),
         )
         return response.choices[0].message.content.strip()
     except Exception as e:
@@ -79,6 +163,109 @@ def get_gpt_response(prompt):
         return f"[ERROR] {type(e).__name__}: {e}"
 
 
+def stream_gpt_response(prompt, model_name=MODEL_NAME, params=None):
+    """
+    Stream the response and cancel as soon as a complete JSON object with all FIELDS has arrived.
+    Returns (text, stats) where stats holds TTFT (seconds), StreamTokens (tokens received, one per content
+    delta, including the chunk read after the object), EarlyStop
+    (True only if the model was still sending text when we cancelled) and TrailingText (text received
+    after the object, i.e. what would otherwise be thrown away).
+    """
+    stats = {"TTFT": None, "StreamTokens": 0, "EarlyStop": False, "TrailingText": ""}
+    scanner = JSONObjectScanner()
+    stream = None
+    complete = None
+    start_time = time.perf_counter()
+    try:
+        wrapped = _force_json_wrapper(prompt)
+        stream = client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": wrapped},
+            ],
+            stream=True,
+            **(CALL_PARAMS if params is None else params),
+        )
+        for chunk in stream:
+            choice = chunk.choices[0] if chunk.choices else None
+            delta = choice.delta.content if choice else None
+            finished = bool(choice and choice.finish_reason)
+            if complete is not None:
+                # One chunk past the object: more text without finish_reason means we cut generation short
+                if delta:
+                    stats["StreamTokens"] += 1
+                    stats["TrailingText"] += delta
+                    stats["EarlyStop"] = not finished
+                if delta or finished:
+                    break
+                continue
+            if not delta:
+                continue
+            if stats["TTFT"] is None:
+                stats["TTFT"] = round(time.perf_counter() - start_time, 4)
+            stats["StreamTokens"] += 1  # one content delta per token
+            complete = scanner.feed(delta)
+            if complete is not None:
+                stats["TrailingText"] = scanner.tail()
+                if finished:
+                    break
+        stats["TrailingText"] = stats["TrailingText"].strip()
+        if complete is not None:
+            return complete.strip(), stats
+        if not scanner.buffer:
+            raise RuntimeError("Empty streamed response from OpenAI.")
+        return scanner.buffer.strip(), stats
+    except Exception as e:
+        return f"[ERROR] {type(e).__name__}: {e}", stats
+    finally:
+        # Closing the HTTP response cancels the rest of the generation
+        if stream is not None:
+            stream.close()
+
+
+def _normalize_label(value) -> str:
+    return str(value).strip().lower()
+
+
+def accept_cheap_response(responses):
+    """
+    Cascade acceptance check on the cheap-model response(s). True means the answer is kept;
+    False means the row is escalated to MODEL_NAME.
+    - Every response must pass is_valid_json after extraction.
+    - "allow_list": each field in CASCADE_ALLOW_LIST must hold one of the allowed labels.
+    - "agreement": all samples must agree on CASCADE_AGREE_FIELDS.
+    - "confidence": CASCADE_CONFIDENCE_FIELD must be a number in [0, 1] and >= CASCADE_CONFIDENCE_THRESHOLD.
+    """
+    parsed = []
+    for response in responses:
+        extracted = extract_json_from_cell(response)
+        if not is_valid_json(extracted):
+            return False
+        parsed.append(json.loads(extracted))
+    first = parsed[0]
+
+    if CASCADE_ACCEPT == "allow_list":
+        return all(
+            _normalize_label(first.get(field, "")) in {_normalize_label(v) for v in allowed}
+            for field, allowed in CASCADE_ALLOW_LIST.items()
+        )
+    if CASCADE_ACCEPT == "agreement":
+        return len(parsed) > 1 and all(
+            _normalize_label(other.get(field)) == _normalize_label(first.get(field))
+            for other in parsed[1:]
+            for field in CASCADE_AGREE_FIELDS
+        )
+    if CASCADE_ACCEPT == "confidence":
+        try:
+            confidence = float(first.get(CASCADE_CONFIDENCE_FIELD))
+        except (TypeError, ValueError):
+            return False
+        # Values off the requested 0-1 scale (e.g. 85 meaning 85%) cannot be compared to the threshold
+        return 0.0 <= confidence <= 1.0 and confidence >= CASCADE_CONFIDENCE_THRESHOLD
+    raise ValueError(f"Unknown CASCADE_ACCEPT mode: {CASCADE_ACCEPT!r}")
+
+
 def correct_json_response(response):
     """Attempt to fix a malformed JSON response while preserving the original information."""
     correction_prompt = f"""
@@ -110,7 +297,7 @@ Required JSON format:
                 {"role": "system", "content": "You are a helpful assistant."},
                 {"role": "user", "content": correction_prompt}
             ],
-            temperature=0,
+            **CALL_PARAMS,
         )
         return correction.choices[0].message.content.strip()
     except Exception as e: